@@ -0,0 +1,138 @@
+"""
+Cost-aware admission control for the cloak endpoints.
+
+Every request is priced from the image header alone (pixels, frame count)
+plus the model passes it asks for (tier, FGSM vs PGD steps), before anything
+is fully decoded. Cost units are roughly "megapixels + model passes" per frame.
+
+A request is admitted only if
+    - in-flight cost stays under max_inflight          (else 503)
+    - the client's token bucket can pay for it         (else 429)
+    - the global token bucket can pay for it           (else 503)
+Rejections carry a Retry-After estimate from the bucket refill rate.
+"""
+import io
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+Rejection = namedtuple("Rejection", ["status", "error", "retry_after"])
+
+
+def probe_image(img_bytes):
+    """(width, height, frames) from the image header, without decoding pixels."""
+    img = Image.open(io.BytesIO(img_bytes))
+    return img.width, img.height, getattr(img, "n_frames", 1)
+
+
+def estimate_cost(width, height, frames=1, passes=1.0):
+    """Decode/encode work scales with pixels, attack work with model passes; both per frame."""
+    return frames * (width * height / 1e6 + passes)
+
+
+class TokenBucket:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost):
+        """Returns 0.0 if cost was paid, else the seconds until it could be."""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def give_back(self, cost):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    def level(self):
+        self._refill()
+        return self.tokens
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        client_capacity=200.0,
+        client_rate=20.0,
+        global_capacity=1000.0,
+        global_rate=100.0,
+        max_inflight=400.0,
+        max_clients=10000,
+    ):
+        self.client_capacity = client_capacity
+        self.client_rate = client_rate
+        self.max_inflight = max_inflight
+        self.max_clients = max_clients
+
+        self._global = TokenBucket(global_capacity, global_rate)
+        self._clients = OrderedDict()
+        self._inflight = 0.0
+        self._admitted = 0
+        self._rejected = {429: 0, 503: 0}
+        self._lock = threading.Lock()
+
+    def max_cost(self):
+        """Largest request any bucket could ever admit."""
+        return min(self.client_capacity, self._global.capacity, self.max_inflight)
+
+    def _client_bucket(self, client):
+        bucket = self._clients.get(client)
+        if bucket is None:
+            bucket = TokenBucket(self.client_capacity, self.client_rate)
+            self._clients[client] = bucket
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client)
+        return bucket
+
+    def admit(self, client, cost):
+        """Returns None when admitted (call release(cost) when done), else a Rejection."""
+        with self._lock:
+            if self._inflight + cost > self.max_inflight:
+                self._rejected[503] += 1
+                return Rejection(503, "Server busy", 1)
+
+            bucket = self._client_bucket(client)
+            wait = bucket.take(cost)
+            if wait > 0:
+                self._rejected[429] += 1
+                return Rejection(429, "Client cost budget exhausted", wait)
+
+            wait = self._global.take(cost)
+            if wait > 0:
+                bucket.give_back(cost)
+                self._rejected[503] += 1
+                return Rejection(503, "Server cost budget exhausted", wait)
+
+            self._inflight += cost
+            self._admitted += 1
+            return None
+
+    def release(self, cost):
+        with self._lock:
+            self._inflight = max(0.0, self._inflight - cost)
+
+    def report(self):
+        with self._lock:
+            return {
+                "inflight_cost": self._inflight,
+                "max_inflight_cost": self.max_inflight,
+                "global_tokens": self._global.level(),
+                "global_capacity": self._global.capacity,
+                "clients_tracked": len(self._clients),
+                "admitted": self._admitted,
+                "rejected_429": self._rejected[429],
+                "rejected_503": self._rejected[503],
+            }
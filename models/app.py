@@ -1,38 +1,261 @@
 import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask_cors import CORS
 
+import numpy as np
 import torch
 import torchvision.transforms as transforms
 import torchvision.models as models
 import torch.nn.functional as F
-from PIL import Image
+from PIL import Image, ImageSequence
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from torchvision.utils import save_image
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
 import io
 from torchvision.utils import save_image
 from torchvision import transforms
+from delta_codec import DELTA_FORMAT, encode_delta
+from gallery import IdentityGallery
+from universal import UniversalPerturbation, load_profile, profile_path
+from admission import AdmissionController, estimate_cost, probe_image
+import timm
+from timm.data import resolve_data_config
 
 
 app = Flask(__name__)
 CORS(app)
 
+# ---- REQUEST LIMITS ----
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+MAX_PIXELS = 40_000_000        # per frame
+MAX_FRAMES = 300
+MAX_INTENSITY = 0.2           # matches the art slider; the face slider stops at 0.1
+# model passes per frame, used to price requests (see admission.py)
+TIER_PASSES = {"fast": 0.3, "standard": 1.0, "max": 2.5}
+METHOD_PASSES = {"fgsm": 1.0, "pgd": 7.0}
+
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+admission = AdmissionController()
+# only honour X-Client-Id behind a proxy / auth layer that sets it itself
+TRUST_CLIENT_ID_HEADER = os.environ.get("MIRAGE_TRUST_CLIENT_ID", "").lower() in ("1", "true", "yes")
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 resnet = models.resnet50(pretrained=True).eval().to(device)
 
 with open("models/imagenet_classes.txt") as f:
     idx_to_class = [line.strip() for line in f.readlines()]
 
-preprocess_224 = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor()
-])
-
 to_tensor = transforms.ToTensor()
-# ImageNet normalization (update if your preprocess_224 uses different values)
+# ImageNet normalization, applied on-device by the fused input layer
 IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).to(device)
 IMAGENET_STD  = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).to(device)
 
+
+# ---- FUSED INPUT LAYER ----
+# Images reach the device as uint8 HWC (4x fewer bytes than float) and are
+# resized, converted and normalized there as layer 0 of the wrapped model, so
+# input gradients come back in [0,1] pixel space with no PIL resize on the way.
+def pil_to_uint8(img):
+    """PIL RGB image -> uint8 tensor [H,W,3] (CPU)."""
+    return torch.from_numpy(np.array(img))
+
+
+def uint8_to_pixels(buf, size=None):
+    """
+    - buf: uint8 tensor [H,W,3] or [B,H,W,3]
+    - size: optional (h, w) to resize to (bilinear, antialiased)
+    Returns float tensor [B,3,h,w] in [0,1] on device
+    """
+    buf = buf.to(device, non_blocking=True)
+    if buf.dim() == 3:
+        buf = buf.unsqueeze(0)
+    x = buf.permute(0, 3, 1, 2).float().div_(255.0)
+    if size is not None and tuple(x.shape[-2:]) != tuple(size):
+        x = F.interpolate(x, size=size, mode="bilinear", align_corners=False, antialias=True)
+    return x
+
+
+class FusedPreprocess(torch.nn.Module):
+    def __init__(self, model, input_size=224, mean=None, std=None, label_map=None):
+        """
+        - model: network to wrap (classifier logits or embeddings)
+        - input_size: square input resolution the model expects
+        - mean / std: per-channel normalization of [0,1] pixels (None = raw pixels)
+        - label_map: for each line of imagenet_classes.txt, the model output index
+          (None = outputs are used as-is)
+        """
+        super().__init__()
+        self.model = model
+        self.input_size = input_size
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(1, 3, 1, 1).to(device)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float32).view(1, 3, 1, 1).to(device)
+        self.label_map = None if label_map is None else torch.tensor(label_map, device=device)
+
+    def pixels(self, buf):
+        """uint8 HWC buffer(s) -> float [B,3,S,S] pixels at the model resolution."""
+        return uint8_to_pixels(buf, (self.input_size, self.input_size))
+
+    def forward(self, x):
+        """x: uint8 [H,W,3] / [B,H,W,3], or float [B,3,h,w] pixels in [0,1] of any size."""
+        if x.dtype == torch.uint8:
+            x = self.pixels(x)
+        elif tuple(x.shape[-2:]) != (self.input_size, self.input_size):
+            x = F.interpolate(x, size=(self.input_size, self.input_size), mode="bilinear",
+                              align_corners=False, antialias=True)
+        if self.mean is not None:
+            x = (x - self.mean) / self.std
+        out = self.model(x)
+        if self.label_map is not None:
+            out = out[:, self.label_map]
+        return out
+
+
+def input_grad(model, x, loss_fn):
+    """
+    - model: FusedPreprocess (or SurrogateEnsemble)
+    - x: uint8 HWC buffer(s) or float [B,3,h,w] pixels
+    - loss_fn: logits -> scalar loss
+    Returns (out, grad, x_px): grad is d loss / d x_px, x_px the [B,3,S,S] pixels the model saw
+    """
+    x_px = model.pixels(x) if x.dtype == torch.uint8 else x
+    x_px = x_px.detach().requires_grad_(True)
+    out = model(x_px)
+    grad = torch.autograd.grad(loss_fn(out), x_px)[0]
+    return out.detach(), grad, x_px.detach()
+
+
+# ---- SURROGATE REGISTRY ----
+# Every surrogate is a FusedPreprocess with its own resize, normalization and
+# label mapping, so the FGSM step and the delta budget are the same for every
+# tier.
+class SurrogateEnsemble(torch.nn.Module):
+    """Averages the logits of several surrogates so one backward pass attacks all of them."""
+
+    input_size = 224
+
+    def __init__(self, members):
+        super().__init__()
+        self.members = torch.nn.ModuleList(members)
+
+    def pixels(self, buf):
+        return uint8_to_pixels(buf, (self.input_size, self.input_size))
+
+    def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = self.pixels(x)
+        return torch.stack([m(x) for m in self.members]).mean(dim=0)
+
+
+def _timm_surrogate(name):
+    model = timm.create_model(name, pretrained=True).eval().to(device)
+    cfg = resolve_data_config({}, model=model)
+    return FusedPreprocess(model, input_size=cfg["input_size"][-1], mean=cfg["mean"], std=cfg["std"])
+
+
+SURROGATE_SPECS = {
+    "resnet50": lambda: FusedPreprocess(resnet, input_size=224, mean=IMAGENET_MEAN, std=IMAGENET_STD),
+    "mobilenetv3_large_100": lambda: _timm_surrogate("mobilenetv3_large_100"),
+    "efficientnet_b0": lambda: _timm_surrogate("efficientnet_b0"),
+    # held out of every tier, see REFERENCE_MODEL
+    "convnext_tiny": lambda: _timm_surrogate("convnext_tiny"),
+}
+
+SURROGATE_TIERS = {
+    "fast": ["mobilenetv3_large_100"],
+    "standard": ["resnet50"],
+    "max": ["resnet50", "efficientnet_b0", "mobilenetv3_large_100"],
+}
+
+_surrogate_cache = {}
+# one lock per model / tier, so a slow first download only blocks requests
+# waiting for that same model
+_surrogate_locks = {key: threading.Lock() for key in [*SURROGATE_SPECS, *SURROGATE_TIERS]}
+
+
+def _cached_build(key, build):
+    model = _surrogate_cache.get(key)
+    if model is not None:
+        return model
+    with _surrogate_locks[key]:
+        if key not in _surrogate_cache:
+            _surrogate_cache[key] = build()
+        return _surrogate_cache[key]
+
+
+def _build_tier(tier):
+    members = [
+        _cached_build(name, lambda name=name: SURROGATE_SPECS[name]().eval())
+        for name in SURROGATE_TIERS[tier]
+    ]
+    return members[0] if len(members) == 1 else SurrogateEnsemble(members).eval()
+
+
+def get_surrogate(tier="standard"):
+    """Lazily builds (and caches) the model used by a tier."""
+    if tier not in SURROGATE_TIERS:
+        raise ValueError(f"Unknown tier: {tier}")
+    return _cached_build(tier, lambda: _build_tier(tier))
+
+
+# Scores every tier's output for /health. A tier scored on its own surrogate
+# always looks strong, so the protection figures only compare across tiers
+# when one model that none of them attacks judges all of them.
+REFERENCE_MODEL = "convnext_tiny"
+
+
+def get_reference_model():
+    return _cached_build(REFERENCE_MODEL, lambda: SURROGATE_SPECS[REFERENCE_MODEL]().eval())
+
+
+# Rolling per-tier figures, published on /health
+_tier_stats = {
+    tier: {"requests": 0, "total_ms": 0.0, "untargeted": 0, "top1_changed": 0, "targeted": 0, "target_hit": 0}
+    for tier in SURROGATE_TIERS
+}
+_tier_stats_lock = threading.Lock()
+
+
+def record_tier_stats(tier, latency_ms, targeted, success):
+    """
+    - success: on the reference model, top-1 == target (targeted) or top-1
+      changed from the clean image (untargeted)
+    """
+    with _tier_stats_lock:
+        stats = _tier_stats[tier]
+        stats["requests"] += 1
+        stats["total_ms"] += latency_ms
+        if targeted:
+            stats["targeted"] += 1
+            stats["target_hit"] += int(success)
+        else:
+            stats["untargeted"] += 1
+            stats["top1_changed"] += int(success)
+
+
+def tier_report():
+    with _tier_stats_lock:
+        report = {}
+        for tier, stats in _tier_stats.items():
+            n, nu, nt = stats["requests"], stats["untargeted"], stats["targeted"]
+            report[tier] = {
+                "surrogates": SURROGATE_TIERS[tier],
+                "reference_model": REFERENCE_MODEL,
+                "requests": n,
+                "mean_latency_ms": stats["total_ms"] / n if n else None,
+                "untargeted_requests": nu,
+                "top1_change_rate": stats["top1_changed"] / nu if nu else None,
+                "targeted_requests": nt,
+                "target_hit_rate": stats["target_hit"] / nt if nt else None,
+            }
+        return report
+
 def pil_to_base64(pil_img, format="PNG"):
     buffer = io.BytesIO()
     pil_img.save(buffer, format=format)
@@ -45,36 +268,77 @@ def base64_to_pil(b64_string):
     return Image.open(io.BytesIO(img_bytes)).convert("RGB")
 
 
+def image_size_from_base64(b64_string):
+    """(width, height) read from the image header, without decoding pixels."""
+    return Image.open(io.BytesIO(base64.b64decode(b64_string))).size
+
+
+def file_to_base64(file_storage):
+    """Multipart upload -> base64 of the original bytes (no decode / PNG re-encode)."""
+    return base64.b64encode(file_storage.read()).decode("utf-8")
+
+
+# Full-resolution decodes run here while the model branch works on a small decode
+_decode_pool = ThreadPoolExecutor(max_workers=4)
+
+
+def _decode_full(img_bytes):
+    return Image.open(io.BytesIO(img_bytes)).convert("RGB")
+
+
+def base64_to_pil_dual(b64_string, model_side, need_full=True):
+    """
+    Decodes the same upload twice:
+    - small: at least model_side x model_side, via JPEG DCT scaling (Image.draft)
+      or a reduce() of the full decode for other formats
+    - full_future: Future resolving to the native-resolution RGB image
+      (None for JPEG when need_full is False)
+    - full_size: native (width, height), read from the header
+    Returns (small, full_future, full_size)
+    """
+    img_bytes = base64.b64decode(b64_string)
+    probe = Image.open(io.BytesIO(img_bytes))
+    full_size = probe.size
+
+    if probe.format == "JPEG":
+        full_future = _decode_pool.submit(_decode_full, img_bytes) if need_full else None
+        probe.draft("RGB", (model_side, model_side))
+        return probe.convert("RGB"), full_future, full_size
+
+    # no DCT shortcut: share the full decode
+    full_future = _decode_pool.submit(_decode_full, img_bytes)
+    full = full_future.result()
+    factor = max(1, min(full.size) // model_side)
+    return (full.reduce(factor) if factor > 1 else full), full_future, full_size
+
+
+def resolve_image(img):
+    """Returns img, waiting for it first if it is a Future from base64_to_pil_dual."""
+    return img.result() if isinstance(img, Future) else img
+
+
 def tensor_to_base64(tensor, format="PNG"):
     buffer = io.BytesIO()
     save_image(tensor, buffer, format=format)
     buffer.seek(0)
     return base64.b64encode(buffer.read()).decode("utf-8")
 
-def fgsm_highres_cloak(pil_img, target_idx, epsilon=0.01, targeted=False):
+def fgsm_delta_small(model_img, target_idx, epsilon=0.01, targeted=False, tier="standard"):
     """
-    - pil_img: PIL RGB image (original full resolution)
-    - target_idx: integer class index
-    - epsilon: float (applied in normalized input-space then converted to pixel-space)
-    - targeted: bool (if True, push *towards* target; else push *away*)
+    - model_img: PIL RGB image (any resolution, resized on device by the surrogate)
+    - target_idx, epsilon, targeted, tier: see fgsm_highres_cloak
     Returns:
-    - perturbed_orig_px: tensor [1,3,H,W] with pixel values in [0,1] at original resolution
+    - delta_px_small: tensor [1,3,S,S], pixel-space delta at model resolution (S = 224)
     """
-    model = resnet
+    model = get_surrogate(tier)
     model.eval()
+    target = torch.tensor([target_idx], device=device)
 
-    # 1) Prepare model input (resized+normalized) for gradient computation
-    x = preprocess_224(pil_img).unsqueeze(0).to(device)   # this is normalized input
-    x.requires_grad = True
+    # 1-2) uint8 upload -> fused resize/normalize -> forward + loss, gradient in pixel space
+    _, grad, _ = input_grad(model, pil_to_uint8(model_img), lambda out: F.cross_entropy(out, target))
 
-    # 2) Forward + loss
-    out = model(x)
-    loss = F.cross_entropy(out, torch.tensor([target_idx], device=device))
-    model.zero_grad()
-    loss.backward()
-
-    # 3) gradient sign in normalized space
-    grad_sign = x.grad.data.sign()  # shape [1,3,224,224] (or whatever preprocess_224 produces)
+    # 3) gradient sign (same sign in pixel and normalized space, std > 0)
+    grad_sign = grad.sign()  # shape [1,3,S,S]
 
     # 4) make delta in normalized space (flip sign for targeted)
     if targeted:
@@ -86,13 +350,32 @@ def fgsm_highres_cloak(pil_img, target_idx, epsilon=0.01, targeted=False):
     #    delta_px_small = delta_norm * std (because x_norm = (x_px - mean)/std -> delta_px = delta_norm * std)
     delta_px_small = delta_norm * IMAGENET_STD  # still small spatial size (e.g. 224x224)
 
-    # 6) upsample delta to original image size
+    return delta_px_small.detach()
+
+
+def fgsm_highres_cloak(pil_img, target_idx, epsilon=0.01, targeted=False, tier="standard", model_img=None):
+    """
+    - pil_img: PIL RGB image (original full resolution), or a Future resolving to one
+    - target_idx: integer class index
+    - epsilon: float (applied in normalized input-space then converted to pixel-space)
+    - targeted: bool (if True, push *towards* target; else push *away*)
+    - tier: surrogate tier from SURROGATE_TIERS ("fast", "standard", "max")
+    - model_img: optional reduced decode used for the gradient (defaults to pil_img)
+    Returns:
+    - perturbed_orig_px: tensor [1,3,H,W] with pixel values in [0,1] at original resolution
+    """
+    delta_px_small = fgsm_delta_small(
+        model_img if model_img is not None else resolve_image(pil_img),
+        target_idx, epsilon=epsilon, targeted=targeted, tier=tier
+    )
+
+    # 6) upsample delta to original image size (full decode is needed from here on)
+    pil_img = resolve_image(pil_img)
     orig_w, orig_h = pil_img.size  # PIL: (width, height)
     delta_px_upsampled = F.interpolate(delta_px_small, size=(orig_h, orig_w), mode="bilinear", align_corners=False)
 
-    # 7) get original image as pixel tensor
-    to_tensor = transforms.ToTensor()
-    orig_px = to_tensor(pil_img).unsqueeze(0).to(device)  # [1,3,H,W], values in [0,1]
+    # 7) get original image as pixel tensor (uint8 transfer, float on device)
+    orig_px = uint8_to_pixels(pil_to_uint8(pil_img))  # [1,3,H,W], values in [0,1]
 
     # 8) apply perturbation and clamp
     perturbed_orig_px = orig_px + delta_px_upsampled
@@ -101,25 +384,46 @@ def fgsm_highres_cloak(pil_img, target_idx, epsilon=0.01, targeted=False):
     return perturbed_orig_px  # [1,3,H,W] in original resolution, ready to save
 
 
+def top_predictions(top):
+    """torch.topk result -> [{"class", "prob"}, ...]"""
+    return [
+        {
+            "class": idx_to_class[top.indices[i]],
+            "prob": float(top.values[i])
+        }
+        for i in range(len(top.indices))
+    ]
+
+
 def art_cloak_from_base64(
     image_b64: str,
     intensity: float = 0.01,
     mode: str = "untargeted",
     target_class_name: str | None = None,
+    tier: str = "standard",
+    output: str = "image",
 ):
     """
     Pure function:
     - Input images as base64
     - Output cloaked image as base64 + predictions
+    - tier selects the surrogate (see SURROGATE_TIERS); predictions come from the same surrogate
+    - output="delta" returns a base64 mirage-delta-v1 blob (see delta_codec) instead of
+      the image; the full-resolution image is then never decoded or encoded
     """
+    if tier not in SURROGATE_TIERS:
+        return None, {"error": f"Invalid tier, expected one of {list(SURROGATE_TIERS)}"}
+
+    start = time.perf_counter()
+    surrogate = get_surrogate(tier)
 
-    # Decode input image
-    orig_img = base64_to_pil(image_b64)
+    # Decode input image: small branch for the model, full branch in the background
+    small_img, full_future, full_size = base64_to_pil_dual(image_b64, 224, need_full=(output != "delta"))
 
     # --- BEFORE PREDICTIONS ---
     with torch.no_grad():
-        x_before = preprocess_224(orig_img).unsqueeze(0).to(device)
-        probs_before = F.softmax(resnet(x_before), dim=1)[0]
+        x_before = surrogate.pixels(pil_to_uint8(small_img))
+        probs_before = F.softmax(surrogate(x_before), dim=1)[0]
 
     targeted = (mode == "targeted")
 
@@ -133,49 +437,130 @@ def art_cloak_from_base64(
         except ValueError:
             return None, {"error": "Invalid class name"}
 
-    # --- HIGH-RES CLOAKING (UNCHANGED) ---
-    perturbed_tensor = fgsm_highres_cloak(
-        pil_img=orig_img,
-        target_idx=target_idx,
-        epsilon=intensity,
-        targeted=targeted
-    )
-
-    # --- AFTER PREDICTIONS ---
-    with torch.no_grad():
-        pert_img_pil = transforms.ToPILImage()(
-            perturbed_tensor.squeeze(0).cpu()
+    if output == "delta":
+        # --- DELTA ONLY: predictions on the model-resolution image ---
+        delta_px_small = fgsm_delta_small(
+            small_img, target_idx, epsilon=intensity, targeted=targeted, tier=tier
+        )
+        with torch.no_grad():
+            x_after = torch.clamp(x_before + delta_px_small, 0.0, 1.0)
+            probs_after = F.softmax(surrogate(x_after), dim=1)[0]
+        cloaked = encode_delta(delta_px_small.cpu().numpy(), full_size)
+        scored = x_after
+    else:
+        # --- HIGH-RES CLOAKING (UNCHANGED) ---
+        perturbed_tensor = fgsm_highres_cloak(
+            pil_img=full_future,
+            model_img=small_img,
+            target_idx=target_idx,
+            epsilon=intensity,
+            targeted=targeted,
+            tier=tier
         )
-        x_after = preprocess_224(pert_img_pil).unsqueeze(0).to(device)
-        probs_after = F.softmax(resnet(x_after), dim=1)[0]
+
+        # --- AFTER PREDICTIONS (resized on device by the surrogate) ---
+        with torch.no_grad():
+            probs_after = F.softmax(surrogate(perturbed_tensor), dim=1)[0]
+        cloaked = perturbed_tensor
+        scored = perturbed_tensor
 
     top_before = torch.topk(probs_before, 3)
     top_after = torch.topk(probs_after, 3)
 
+    latency_ms = (time.perf_counter() - start) * 1000.0
+
+    # --- TIER STATS (reference model, outside the reported latency) ---
+    reference = get_reference_model()
+    with torch.no_grad():
+        ref_before = reference(x_before).argmax(dim=1).item()
+        ref_after = reference(scored).argmax(dim=1).item()
+    record_tier_stats(tier, latency_ms, targeted, ref_after == target_idx if targeted else ref_after != ref_before)
+
     response = {
         "mode": mode,
+        "tier": tier,
+        "latency_ms": latency_ms,
         "target_class": target_class_name,
-        "original_top_predictions": [
-            {
-                "class": idx_to_class[top_before.indices[i]],
-                "prob": float(top_before.values[i])
-            }
-            for i in range(3)
-        ],
-        "cloaked_top_predictions": [
-            {
-                "class": idx_to_class[top_after.indices[i]],
-                "prob": float(top_after.values[i])
-            }
-            for i in range(3)
-        ],
+        "original_top_predictions": top_predictions(top_before),
+        "cloaked_top_predictions": top_predictions(top_after),
     }
 
-    cloaked_b64 = tensor_to_base64(perturbed_tensor)
+    if output == "delta":
+        cloaked_b64 = base64.b64encode(cloaked).decode("utf-8")
+    else:
+        cloaked_b64 = tensor_to_base64(cloaked)
 
     return cloaked_b64, response
 
 
+# Per-image fine-tune step on top of a profile, as a fraction of its budget
+PROFILE_FINETUNE_STEP = 0.5
+
+
+def art_cloak_from_profile(
+    image_b64: str,
+    profile_name: str,
+    finetune: bool = False,
+    output: str = "image",
+):
+    """
+    Pure function:
+    - Applies a stored universal perturbation (see universal.py): resize + add + clamp,
+      no model call
+    - finetune adds one FGSM step from the stored delta on this image (one surrogate
+      forward/backward), kept inside the profile's budget
+    """
+    try:
+        profile = load_profile(profile_name)
+    except ValueError as e:
+        return None, {"error": str(e)}
+    if profile is None:
+        return None, {"error": f"Unknown profile: {profile_name}"}
+
+    start = time.perf_counter()
+    delta = profile["delta"].float().unsqueeze(0).to(device)
+
+    if finetune:
+        small_img, full_future, full_size = base64_to_pil_dual(image_b64, 224, need_full=(output != "delta"))
+        surrogate = get_surrogate(profile["tier"])
+        bound = profile["epsilon"] * IMAGENET_STD
+
+        x = surrogate.pixels(pil_to_uint8(small_img))
+        if profile["target_class"] is None:
+            with torch.no_grad():
+                labels = surrogate(x).argmax(dim=1)
+        else:
+            labels = torch.tensor([idx_to_class.index(profile["target_class"])], device=device)
+
+        _, grad, _ = input_grad(
+            surrogate, torch.clamp(x + delta, 0.0, 1.0), lambda out: F.cross_entropy(out, labels)
+        )
+        grad_sign = -grad.sign() if profile["targeted"] else grad.sign()
+        delta = delta + PROFILE_FINETUNE_STEP * bound * grad_sign
+        delta = torch.max(torch.min(delta, bound), -bound)
+    elif output == "delta":
+        full_future, full_size = None, image_size_from_base64(image_b64)
+    else:
+        full_future = base64_to_pil(image_b64)
+        full_size = full_future.size
+
+    if output == "delta":
+        cloaked_b64 = base64.b64encode(encode_delta(delta.cpu().numpy(), full_size)).decode("utf-8")
+    else:
+        orig_px = uint8_to_pixels(pil_to_uint8(resolve_image(full_future)))
+        with torch.no_grad():
+            cloaked_b64 = tensor_to_base64(UniversalPerturbation(delta)(orig_px))
+
+    response = {
+        "profile": profile_name,
+        "tier": profile["tier"],
+        "epsilon": profile["epsilon"],
+        "finetuned": finetune,
+        "latency_ms": (time.perf_counter() - start) * 1000.0,
+    }
+    return cloaked_b64, response
+
+
 # @app.route("/art-cloak", methods=["POST"])
 # def cloak_image():
 #     image_file = request.files.get("image")
@@ -255,13 +640,90 @@ def art_cloak_from_base64(
 #         "cloaked_image": encoded_string,
 #         "response": response
 #     }), 200
-    
+
+def client_id():
+    """Key for the per-client budget: the peer address unless a trusted proxy sets X-Client-Id."""
+    if TRUST_CLIENT_ID_HEADER and request.headers.get("X-Client-Id"):
+        return request.headers["X-Client-Id"]
+    return request.remote_addr or "anonymous"
+
+
+def admit_request(image_b64, passes, frames="first", intensity=None, extra_images=()):
+    """
+    Prices the request from the image header and charges the admission budgets
+    before any full decode. extra_images (e.g. a face-cloak target) are checked
+    against the same limits and charged once for their pixels.
+    Returns an error response, or None when admitted (the cost is released in
+    release_admission).
+    """
+    if intensity is not None and not 0.0 <= intensity <= MAX_INTENSITY:
+        return jsonify({"error": f"intensity must be in [0, {MAX_INTENSITY}]"}), 400
+
+    sizes = []
+    for b64 in (image_b64, *extra_images):
+        try:
+            width, height, n_frames = probe_image(base64.b64decode(b64))
+        except Image.DecompressionBombError:
+            # Pillow refuses headers past 2 * MAX_IMAGE_PIXELS before we can check them
+            return jsonify({"error": f"Image exceeds {MAX_PIXELS} pixels"}), 413
+        except Exception:
+            return jsonify({"error": "Unreadable image"}), 400
+        if width * height > MAX_PIXELS:
+            return jsonify({"error": f"Image exceeds {MAX_PIXELS} pixels"}), 413
+        sizes.append((width, height, n_frames))
+
+    width, height, n_frames = sizes[0]
+    if frames == "all" and n_frames > MAX_FRAMES:
+        return jsonify({"error": f"Animation exceeds {MAX_FRAMES} frames"}), 413
+
+    cost = estimate_cost(width, height, n_frames if frames == "all" else 1, passes)
+    cost += sum(w * h / 1e6 for w, h, _ in sizes[1:])
+    if cost > admission.max_cost():
+        return jsonify({"error": "Request too expensive, reduce size, frames or steps"}), 413
+
+    rejection = admission.admit(client_id(), cost)
+    if rejection is not None:
+        response = jsonify({"error": rejection.error, "retry_after": rejection.retry_after})
+        response.headers["Retry-After"] = str(max(1, int(rejection.retry_after + 0.999)))
+        return response, rejection.status
+
+    g.admitted_cost = cost
+    return None
+
+
+@app.teardown_request
+def release_admission(exc):
+    cost = g.pop("admitted_cost", None)
+    if cost is not None:
+        admission.release(cost)
+
+
+def cloak_payload(cloaked_b64, response, output="image"):
+    """JSON body shared by the cloak endpoints for both output modes."""
+    if output == "delta":
+        return {
+            "cloaked_delta": cloaked_b64,
+            "delta_format": DELTA_FORMAT,
+            "response": response
+        }
+    return {
+        "cloaked_image": cloaked_b64,
+        "response": response
+    }
+
+
 @app.route("/art-cloak", methods=["POST"])
 def cloak_image():
     """
     Accepts:
     - multipart image OR image_base64
     - optional target_class
+    - optional tier: "fast" | "standard" | "max"
+    - optional output: "image" (default) | "delta"
+    - optional frames: "first" (default) | "all" (animated input, NDJSON stream per frame;
+      image output only)
+    - optional profile: apply a stored universal perturbation instead of attacking
+      (+ finetune: "true" for one per-image refinement step)
     """
 
     # ---- IMAGE INPUT ----
@@ -271,29 +733,85 @@ def cloak_image():
         image_file = request.files.get("image")
         if image_file is None:
             return jsonify({"error": "No image provided"}), 400
-        orig_img = Image.open(image_file).convert("RGB")
-        image_b64 = pil_to_base64(orig_img)
+        image_b64 = file_to_base64(image_file)
 
-    # ---- PARAMS ----
+    # ---- PARAMS (validated before admission charges the client) ----
     target_class_name = request.form.get("target_class", None)
-    intensity = float(request.form.get("intensity", 0.01))
-    mode = request.form.get("mode", "untargeted")
+    try:
+        intensity = float(request.form.get("intensity", 0.01))
+    except ValueError:
+        return jsonify({"error": "intensity must be a number"}), 400
+    mode = request.form.get("mode", "untargeted").lower()
+    tier = request.form.get("tier", "standard").lower()
+    output = request.form.get("output", "image").lower()
+    frames = request.form.get("frames", "first").lower()
+    profile = request.form.get("profile")
+    finetune = request.form.get("finetune", "false").lower() == "true"
+
+    if frames not in ("first", "all"):
+        return jsonify({"error": "frames must be 'first' or 'all'"}), 400
+    if frames == "all" and (output != "image" or profile is not None):
+        return jsonify({"error": "frames=all streams cloaked images; output=delta and profile are not supported"}), 400
+
+    if profile is not None:
+        try:
+            if not os.path.exists(profile_path(profile)):
+                return jsonify({"error": f"Unknown profile: {profile}"}), 400
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        if mode not in ("untargeted", "targeted"):
+            return jsonify({"error": "mode must be 'untargeted' or 'targeted'"}), 400
+        if tier not in SURROGATE_TIERS:
+            return jsonify({"error": f"Invalid tier, expected one of {list(SURROGATE_TIERS)}"}), 400
+        if target_class_name is not None and target_class_name not in idx_to_class:
+            return jsonify({"error": "Invalid class name"}), 400
+
+    # ---- PROFILE ----
+    if profile is not None:
+        rejected = admit_request(image_b64, 1.0 if finetune else 0.0)
+        if rejected is not None:
+            return rejected
+
+        cloaked_b64, response = art_cloak_from_profile(
+            image_b64=image_b64,
+            profile_name=profile,
+            finetune=finetune,
+            output=output
+        )
+        if cloaked_b64 is None:
+            return jsonify(response), 400
+        return jsonify(cloak_payload(cloaked_b64, response, output)), 200
+
+    # ---- ADMISSION ----
+    rejected = admit_request(image_b64, TIER_PASSES[tier], frames=frames, intensity=intensity)
+    if rejected is not None:
+        return rejected
+
+    if frames == "all":
+        target_idx = None if target_class_name is None else idx_to_class.index(target_class_name)
+        return frames_response(art_cloak_frames(
+            image_b64,
+            intensity=intensity,
+            targeted=(mode == "targeted"),
+            target_idx=target_idx,
+            tier=tier
+        ))
 
     # ---- CALL PURE FUNCTION ----
     cloaked_b64, response = art_cloak_from_base64(
         image_b64=image_b64,
         intensity=intensity,
         mode=mode,
-        target_class_name=target_class_name
+        target_class_name=target_class_name,
+        tier=tier,
+        output=output
     )
 
     if cloaked_b64 is None:
         return jsonify(response), 400
 
-    return jsonify({
-        "cloaked_image": cloaked_b64,
-        "response": response
-    }), 200
+    return jsonify(cloak_payload(cloaked_b64, response, output)), 200
 
 
 
@@ -301,100 +819,228 @@ def cloak_image():
 def home():
     return "Mirage-AI FGSM High-Res Cloak API is running!"
 
+
+@app.route("/health")
+def health():
+    """Service status, current load, and measured latency / protection figures per art-cloak tier."""
+    load = admission.report()
+    return jsonify({
+        "status": "busy" if load["inflight_cost"] >= 0.8 * load["max_inflight_cost"] else "ok",
+        "device": device,
+        "load": load,
+        "tiers": tier_report(),
+        "gallery_identities": len(gallery) if gallery is not None else 0,
+    }), 200
+
 mtcnn = MTCNN(keep_all=False, device=device)
 
 facenet = InceptionResnetV1(pretrained="vggface2").eval().to(device)
 
-face_preprocess = transforms.Compose([
-    transforms.Resize((160, 160)),
-    transforms.ToTensor()
-])
+# fixed_image_standardization, (x * 255 - 127.5) / 128, as FaceNet was trained with
+facenet_fused = FusedPreprocess(facenet, input_size=160, mean=[127.5 / 255] * 3, std=[128 / 255] * 3).eval()
 
-to_tensor = transforms.ToTensor()
+# Optional identity gallery (see gallery.py) used to report recognition rank
+# before / after cloaking; MIRAGE_GALLERY points at a built gallery directory.
+gallery = IdentityGallery(os.environ["MIRAGE_GALLERY"]) if os.environ.get("MIRAGE_GALLERY") else None
 
-def cloak_face_facenet(
-    orig_img,
-    intensity=0.01,
-    method="fgsm",
-    targeted=False,
-    target_identity_img=None
-):
-    orig_w, orig_h = orig_img.size
+# ---- FACE DETECTION ----
+# MTCNN's image pyramid grows with the input size, so detection runs on a
+# bounded proxy and boxes are mapped back (and optionally refined on a
+# native-resolution crop). Faces smaller than ~20px on the proxy are missed.
+DETECT_MAX_SIDE = 1024
+REFINE_MAX_SIDE = 512
+REFINE_MARGIN = 0.25
+REFINE_MIN_IOU = 0.3
+DETECT_CACHE_SIZE = 256
 
-    boxes, probs = mtcnn.detect(orig_img)
-    if boxes is None:
-        return None, {"error": "No face detected"}
+_detect_cache = OrderedDict()
+_detect_cache_lock = threading.Lock()
 
-    x1, y1, x2, y2 = map(int, boxes[0])
-    face_crop = orig_img.crop((x1, y1, x2, y2))
 
-    face_small = face_preprocess(face_crop).unsqueeze(0).to(device)
-    face_small.requires_grad = True
+def image_digest(image_b64):
+    return hashlib.sha256(image_b64.encode("utf-8")).hexdigest()
 
-    orig_emb = facenet(face_small).detach()
 
-    if targeted:
-        target_face = face_preprocess(target_identity_img).unsqueeze(0).to(device)
-        target_emb = facenet(target_face).detach()
-    else:
-        target_emb = None
+def _detect_bounded(img, max_side):
+    """mtcnn.detect on img shrunk to max_side; returns boxes in img coordinates (or None)."""
+    w, h = img.size
+    scale = min(1.0, max_side / max(w, h))
+    if scale < 1.0:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BILINEAR)
+    boxes, _ = mtcnn.detect(img)
+    if boxes is None:
+        return None
+    return boxes / scale
 
-    def untargeted_loss(adv_emb):
-        return -F.cosine_similarity(adv_emb, orig_emb).mean()
 
-    def targeted_loss(adv_emb):
-        return F.cosine_similarity(adv_emb, target_emb).mean()
+def _box_iou(box, boxes):
+    """IoU of one box [4] against boxes [N,4]."""
+    ix1 = np.maximum(box[0], boxes[:, 0])
+    iy1 = np.maximum(box[1], boxes[:, 1])
+    ix2 = np.minimum(box[2], boxes[:, 2])
+    iy2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (area + areas - inter + 1e-12)
 
-    if method == "fgsm":
-        emb = facenet(face_small)
-        loss = targeted_loss(emb) if targeted else untargeted_loss(emb)
-        loss.backward()
 
-        epsilon = intensity
-        adv_small = torch.clamp(face_small + epsilon * face_small.grad.sign(), 0, 1).detach()
+def _refine_box(img, box):
+    """
+    Re-detects box on a native-resolution margin crop. Keeps the crop detection
+    that overlaps box best, so a larger neighbouring face cannot take over; falls
+    back to box when nothing overlaps at least REFINE_MIN_IOU.
+    """
+    x1, y1, x2, y2 = box
+    mx, my = (x2 - x1) * REFINE_MARGIN, (y2 - y1) * REFINE_MARGIN
+    cx1, cy1 = max(0, int(x1 - mx)), max(0, int(y1 - my))
+    cx2, cy2 = min(img.width, int(x2 + mx)), min(img.height, int(y2 + my))
 
-    elif method == "pgd":
-        adv_small = face_small.clone()
-        epsilon = intensity
-        alpha = epsilon / 3
-        steps = 7
+    crop_boxes = _detect_bounded(img.crop((cx1, cy1, cx2, cy2)), REFINE_MAX_SIDE)
+    if crop_boxes is None:
+        return box
+    crop_boxes = crop_boxes + np.array([cx1, cy1, cx1, cy1])
+    iou = _box_iou(box, crop_boxes)
+    best = int(iou.argmax())
+    return crop_boxes[best] if iou[best] >= REFINE_MIN_IOU else box
 
-        for _ in range(steps):
-            adv_small = adv_small.detach()
-            adv_small.requires_grad_(True)
 
-            emb = facenet(adv_small)
-            loss = targeted_loss(emb) if targeted else untargeted_loss(emb)
-            loss.backward()
+def detect_faces(img, digest=None, refine=True, full_img=None, max_faces=1):
+    """
+    - img: PIL RGB image to detect on
+    - digest: optional cache key (see image_digest); repeated requests skip detection
+    - refine: re-detect each kept box on a native-resolution crop when the proxy was downscaled
+    - full_img: when img is a reduced decode, the native image (or a Future resolving
+      to it); boxes are rescaled to and refined on it
+    - max_faces: keep only the largest max_faces boxes (callers use boxes[0])
+    Returns:
+    - boxes: float array [N,4] (x1, y1, x2, y2) in native coordinates, or None if no face
+    """
+    if digest is not None:
+        with _detect_cache_lock:
+            if digest in _detect_cache:
+                _detect_cache.move_to_end(digest)
+                boxes = _detect_cache[digest]
+                return None if boxes is None else boxes.copy()
+
+    boxes = _detect_bounded(img, DETECT_MAX_SIDE)
+    if boxes is not None:
+        # mtcnn.detect returns every face, largest first
+        boxes = boxes[:max_faces]
+    if full_img is not None:
+        full_img = resolve_image(full_img)
+        if boxes is not None:
+            sx, sy = full_img.width / img.width, full_img.height / img.height
+            boxes = boxes * np.array([sx, sy, sx, sy])
+        img = full_img
+    if boxes is not None:
+        if refine and max(img.size) > DETECT_MAX_SIDE:
+            boxes = np.stack([_refine_box(img, box) for box in boxes])
+        boxes = np.clip(boxes, 0, [img.width, img.height, img.width, img.height])
+
+    if digest is not None:
+        with _detect_cache_lock:
+            _detect_cache[digest] = boxes
+            while len(_detect_cache) > DETECT_CACHE_SIZE:
+                _detect_cache.popitem(last=False)
+
+    return None if boxes is None else boxes.copy()
+
+
+def facenet_attack(face_small, intensity=0.01, method="fgsm", target_emb=None):
+    """
+    Batched FGSM / PGD against FaceNet embeddings.
+    - face_small: tensor [B,3,160,160] in [0,1]
+    - method: "fgsm" (one step of size intensity) or "pgd" (7 steps of intensity/3)
+    - target_emb: [1,512] or [B,512] to pull towards; None pushes away from the own embedding
+    Returns:
+    - delta_small: tensor [B,3,160,160], L-inf bounded by intensity
+    - orig_emb: tensor [B,512]
+    """
+    face_small = face_small.detach()
+    with torch.no_grad():
+        orig_emb = facenet_fused(face_small)
 
-            adv_small = adv_small + alpha * adv_small.grad.sign()
-            adv_small = torch.min(torch.max(adv_small, face_small - epsilon), face_small + epsilon)
-            adv_small = torch.clamp(adv_small, 0, 1)
+    def loss_fn(emb):
+        # summed so every sample in the batch gets its own gradient
+        if target_emb is not None:
+            return F.cosine_similarity(emb, target_emb).sum()
+        return -F.cosine_similarity(emb, orig_emb).sum()
 
-    delta_small = adv_small - face_small
+    epsilon = intensity
+    alpha, steps = (epsilon / 3, 7) if method == "pgd" else (epsilon, 1)
 
-    face_H = y2 - y1
-    face_W = x2 - x1
+    adv_small = face_small.clone()
+    for _ in range(steps):
+        adv_small.requires_grad_(True)
+        grad = torch.autograd.grad(loss_fn(facenet_fused(adv_small)), adv_small)[0]
 
-    delta_big = torch.nn.functional.interpolate(
-        delta_small,
-        size=(face_H, face_W),
-        mode='bilinear',
-        align_corners=False
-    )
+        adv_small = adv_small.detach() + alpha * grad.sign()
+        adv_small = torch.min(torch.max(adv_small, face_small - epsilon), face_small + epsilon)
+        adv_small = torch.clamp(adv_small, 0, 1)
 
-    orig_tensor = to_tensor(orig_img).unsqueeze(0).to(device)
-    perturbed = orig_tensor.clone()
+    return adv_small - face_small, orig_emb
+
+
+def apply_face_delta(orig_tensor, delta_small, box):
+    """Upsamples delta_small into box of orig_tensor [B,3,H,W] and clamps; returns a new tensor."""
+    x1, y1, x2, y2 = box
+    delta_big = F.interpolate(delta_small, size=(y2 - y1, x2 - x1), mode='bilinear', align_corners=False)
 
+    perturbed = orig_tensor.clone()
     perturbed[:, :, y1:y2, x1:x2] = torch.clamp(
         orig_tensor[:, :, y1:y2, x1:x2] + delta_big,
         0, 1
     )
+    return perturbed
+
+
+def face_embedding(img):
+    """FaceNet embedding [512] (numpy) of the first detected face in img, or None."""
+    boxes = detect_faces(img)
+    if boxes is None:
+        return None
+    x1, y1, x2, y2 = map(int, boxes[0])
+    with torch.no_grad():
+        emb = facenet_fused(pil_to_uint8(img.crop((x1, y1, x2, y2))))
+    return emb[0].cpu().numpy()
+
+
+def face_embedding_from_path(path):
+    return face_embedding(Image.open(path).convert("RGB"))
+
+
+def gallery_ranks(orig_emb, adv_emb, identity=None):
+    """
+    Rank of the true identity in the loaded gallery for the original and cloaked face.
+    identity None takes the original face's top gallery match as the true identity;
+    rank_before is then 1 by construction, so it is reported as None.
+    """
+    if identity is not None and identity not in gallery:
+        return {"error": f"Unknown gallery identity: {identity}"}
+
+    start = time.perf_counter()
+    inferred = identity is None
+    queries = torch.cat([orig_emb, adv_emb]).cpu().numpy()
+    identity, (rank_before, rank_after) = gallery.ranks(queries, identity)
+
+    return {
+        "identity": identity,
+        "identity_inferred": inferred,
+        "gallery_size": len(gallery),
+        "rank_before": None if inferred else int(rank_before),
+        "rank_after": int(rank_after),
+        "search_ms": (time.perf_counter() - start) * 1000.0,
+    }
 
-    adv_face_crop = transforms.ToPILImage()(perturbed[0, :, y1:y2, x1:x2].cpu())
-    adv_face_small = face_preprocess(adv_face_crop).unsqueeze(0).to(device)
-    adv_emb = facenet(adv_face_small).detach()
 
+def face_metrics(orig_emb, adv_emb, face_hw, target_emb=None, gallery_identity=None):
+    """
+    Cloak metrics from the FaceNet embeddings of the original and cloaked face.
+    - face_hw: (height, width) of the face box in the output image
+    - target_emb: target identity embedding for targeted attacks
+    """
+    face_H, face_W = face_hw
     metrics = {}
 
     orig_sim = float(F.cosine_similarity(orig_emb, orig_emb))
@@ -422,7 +1068,7 @@ def cloak_face_facenet(
 
     metrics["effective_cloaking_score"] = min(1.0, (1 - adv_sim) * 1.3)
 
-    if targeted:
+    if target_emb is not None:
         tgt_sim_before = float(F.cosine_similarity(orig_emb, target_emb))
         tgt_sim_after = float(F.cosine_similarity(adv_emb, target_emb))
 
@@ -432,7 +1078,107 @@ def cloak_face_facenet(
 
         metrics["target_push_strength"] = max(0.0, metrics["push_toward_target"])
 
-    return perturbed, metrics
+    if gallery is not None:
+        metrics["gallery"] = gallery_ranks(orig_emb, adv_emb, gallery_identity)
+
+    return metrics
+
+
+def face_delta(
+    orig_img,
+    intensity=0.01,
+    method="fgsm",
+    targeted=False,
+    target_identity_img=None,
+    digest=None,
+    detect_img=None,
+    gallery_identity=None,
+    with_metrics=True
+):
+    """
+    - orig_img: PIL RGB image (original full resolution), or a Future resolving to one
+    - detect_img: optional reduced decode to run face detection on
+    - gallery_identity: true identity label for the gallery rank metrics (when a gallery is loaded)
+    - with_metrics: False skips the metrics (and gallery search) for callers that
+      measure the final image themselves
+    Returns:
+    - delta_small: tensor [1,3,160,160], pixel-space delta for the face box (None if no face)
+    - box: (x1, y1, x2, y2) the delta is upsampled into
+    - metrics: dict
+    """
+    if detect_img is not None:
+        boxes = detect_faces(detect_img, digest=digest, full_img=orig_img)
+    else:
+        boxes = detect_faces(resolve_image(orig_img), digest=digest)
+    orig_img = resolve_image(orig_img)
+    if boxes is None:
+        return None, None, {"error": "No face detected"}
+
+    x1, y1, x2, y2 = map(int, boxes[0])
+    face_u8 = pil_to_uint8(orig_img.crop((x1, y1, x2, y2)))
+
+    face_small = facenet_fused.pixels(face_u8)
+
+    if targeted:
+        with torch.no_grad():
+            target_emb = facenet_fused(pil_to_uint8(target_identity_img))
+    else:
+        target_emb = None
+
+    delta_small, orig_emb = facenet_attack(face_small, intensity=intensity, method=method, target_emb=target_emb)
+    if not with_metrics:
+        return delta_small.detach(), (x1, y1, x2, y2), {}
+
+    face_H = y2 - y1
+    face_W = x2 - x1
+
+    delta_big = torch.nn.functional.interpolate(
+        delta_small,
+        size=(face_H, face_W),
+        mode='bilinear',
+        align_corners=False
+    )
+
+    orig_face = uint8_to_pixels(face_u8)
+    adv_face = torch.clamp(orig_face + delta_big, 0, 1)
+
+    with torch.no_grad():
+        adv_emb = facenet_fused(adv_face)
+
+    metrics = face_metrics(orig_emb, adv_emb, (face_H, face_W), target_emb, gallery_identity)
+
+    return delta_small.detach(), (x1, y1, x2, y2), metrics
+
+
+def cloak_face_facenet(
+    orig_img,
+    intensity=0.01,
+    method="fgsm",
+    targeted=False,
+    target_identity_img=None,
+    digest=None,
+    detect_img=None,
+    gallery_identity=None
+):
+    """
+    Same arguments as face_delta; applies the delta to the full-resolution image.
+    Returns (perturbed [1,3,H,W] in [0,1], metrics), perturbed is None if no face
+    """
+    delta_small, box, metrics = face_delta(
+        orig_img,
+        intensity=intensity,
+        method=method,
+        targeted=targeted,
+        target_identity_img=target_identity_img,
+        digest=digest,
+        detect_img=detect_img,
+        gallery_identity=gallery_identity
+    )
+    if delta_small is None:
+        return None, metrics
+
+    orig_tensor = uint8_to_pixels(pil_to_uint8(resolve_image(orig_img)))
+    return apply_face_delta(orig_tensor, delta_small, box), metrics
 
 
 
@@ -443,15 +1189,19 @@ def face_cloak_from_base64(
     method: str = "fgsm",
     targeted: bool = False,
     target_image_b64: str | None = None,
+    output: str = "image",
+    gallery_identity: str | None = None,
 ):
     """
     Pure function:
     - Takes images as base64
     - Returns base64 cloaked image + metrics
+    - output="delta" returns a base64 mirage-delta-v1 blob (see delta_codec) holding
+      only the quantized face patch and its box; no full-resolution encode
     """
 
-    # Decode input image
-    orig_img = base64_to_pil(image_b64)
+    # Decode input image: proxy for detection, full branch in the background
+    detect_img, full_future, _ = base64_to_pil_dual(image_b64, DETECT_MAX_SIDE)
 
     target_identity_img = None
     if targeted:
@@ -459,13 +1209,32 @@ def face_cloak_from_base64(
             return None, {"error": "Targeted attack requires target_image"}
         target_identity_img = base64_to_pil(target_image_b64)
 
+    if output == "delta":
+        delta_small, box, metrics = face_delta(
+            full_future,
+            intensity=intensity,
+            method=method,
+            targeted=targeted,
+            target_identity_img=target_identity_img,
+            digest=image_digest(image_b64),
+            detect_img=detect_img,
+            gallery_identity=gallery_identity
+        )
+        if delta_small is None:
+            return None, metrics
+        blob = encode_delta(delta_small.cpu().numpy(), resolve_image(full_future).size, box)
+        return base64.b64encode(blob).decode("utf-8"), metrics
+
     # ---- CORE PROCESSING (UNCHANGED) ----
     perturbed_tensor, metrics = cloak_face_facenet(
-        orig_img,
+        full_future,
         intensity=intensity,
         method=method,
         targeted=targeted,
-        target_identity_img=target_identity_img
+        target_identity_img=target_identity_img,
+        digest=image_digest(image_b64),
+        detect_img=detect_img,
+        gallery_identity=gallery_identity
     )
 
     if perturbed_tensor is None:
@@ -478,12 +1247,291 @@ def face_cloak_from_base64(
 
 
 
+def combined_cloak_from_base64(
+    image_b64: str,
+    intensity: float = 0.01,
+    mode: str = "untargeted",
+    target_class_name: str | None = None,
+    tier: str = "standard",
+    method: str = "fgsm",
+    budget: float | None = None,
+    gallery_identity: str | None = None,
+):
+    """
+    Pure function:
+    - Art (surrogate FGSM) and face (MTCNN + FaceNet) protection in one pass:
+      one decode, one shared full-resolution tensor, one PNG encode
+    - The two deltas are summed and clipped to a shared L-inf budget in pixel
+      space (default: intensity)
+    - Returns base64 cloaked image + {"art": ..., "face": ...} metrics
+    """
+    if tier not in SURROGATE_TIERS:
+        return None, {"error": f"Invalid tier, expected one of {list(SURROGATE_TIERS)}"}
+
+    start = time.perf_counter()
+    budget = intensity if budget is None else budget
+    surrogate = get_surrogate(tier)
+
+    small_img, full_future, _ = base64_to_pil_dual(image_b64, 224)
+
+    # ---- ART DELTA (model resolution) ----
+    with torch.no_grad():
+        probs_before = F.softmax(surrogate(surrogate.pixels(pil_to_uint8(small_img))), dim=1)[0]
+
+    targeted = (mode == "targeted")
+    if target_class_name is None:
+        target_idx = torch.argmax(probs_before).item()
+        target_class_name = idx_to_class[target_idx]
+    else:
+        try:
+            target_idx = idx_to_class.index(target_class_name)
+        except ValueError:
+            return None, {"error": "Invalid class name"}
+
+    art_delta = fgsm_delta_small(small_img, target_idx, epsilon=intensity, targeted=targeted, tier=tier)
+
+    # ---- FACE DELTA (face box) ----
+    face_delta_small, box, face_info = face_delta(
+        full_future,
+        intensity=intensity,
+        method=method,
+        digest=image_digest(image_b64),
+        with_metrics=False
+    )
+
+    # ---- COMBINE ON THE SHARED FULL-RES TENSOR ----
+    orig_px = uint8_to_pixels(pil_to_uint8(resolve_image(full_future)))
+    delta = F.interpolate(art_delta, size=orig_px.shape[-2:], mode="bilinear", align_corners=False)
+    if face_delta_small is not None:
+        x1, y1, x2, y2 = box
+        delta[:, :, y1:y2, x1:x2] += F.interpolate(
+            face_delta_small, size=(y2 - y1, x2 - x1), mode="bilinear", align_corners=False
+        )
+    delta = torch.clamp(delta, -budget, budget)
+    perturbed = torch.clamp(orig_px + delta, 0.0, 1.0)
+
+    # ---- MERGED METRICS (measured on the returned image) ----
+    with torch.no_grad():
+        probs_after = F.softmax(surrogate(perturbed), dim=1)[0]
+        if face_delta_small is not None:
+            emb_before = facenet_fused(orig_px[:, :, y1:y2, x1:x2])
+            emb_after = facenet_fused(perturbed[:, :, y1:y2, x1:x2])
+    if face_delta_small is not None:
+        face_info = face_metrics(emb_before, emb_after, (y2 - y1, x2 - x1), gallery_identity=gallery_identity)
+        face_info["face_box"] = [x1, y1, x2, y2]
+    face_info["face_detected"] = face_delta_small is not None
+
+    top_before = torch.topk(probs_before, 3)
+    top_after = torch.topk(probs_after, 3)
+
+    response = {
+        "budget": budget,
+        "latency_ms": (time.perf_counter() - start) * 1000.0,
+        "art": {
+            "mode": mode,
+            "tier": tier,
+            "target_class": target_class_name,
+            "original_top_predictions": top_predictions(top_before),
+            "cloaked_top_predictions": top_predictions(top_after),
+        },
+        "face": face_info,
+    }
+
+    return tensor_to_base64(perturbed), response
+
+
+# ---- MULTI-FRAME (GIF / animated WebP / APNG) ----
+# Frames are decoded lazily and processed FRAME_WINDOW at a time. A frame is a
+# keyframe when its thumbnail differs from the previous keyframe by more than
+# the change threshold; only keyframes hit the models, the others reuse the
+# keyframe's delta (and face box).
+FRAME_WINDOW = 8
+FRAME_CHANGE_THRESHOLD = 0.02
+
+
+def _frame_windows(image_b64, window=FRAME_WINDOW):
+    img = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+    batch = []
+    for frame in ImageSequence.Iterator(img):
+        batch.append((frame.convert("RGB"), frame.info.get("duration", img.info.get("duration", 100))))
+        if len(batch) == window:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _frame_signature(frame):
+    return to_tensor(frame.resize((64, 64), Image.BILINEAR))
+
+
+def _select_keyframes(window, ref_sig, threshold):
+    """Returns (keyframe flag per frame, signature of the last keyframe)."""
+    flags = []
+    for frame, _ in window:
+        sig = _frame_signature(frame)
+        changed = ref_sig is None or float((sig - ref_sig).abs().mean()) > threshold
+        if changed:
+            ref_sig = sig
+        flags.append(changed)
+    return flags, ref_sig
+
+
+def detect_faces_batch(frames):
+    """One bounded-proxy MTCNN call for same-size frames; returns an int box or None per frame."""
+    w, h = frames[0].size
+    scale = min(1.0, DETECT_MAX_SIDE / max(w, h))
+    if scale < 1.0:
+        frames = [f.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BILINEAR) for f in frames]
+
+    batch_boxes, _ = mtcnn.detect(frames)
+    out = []
+    for boxes in batch_boxes:
+        if boxes is None:
+            out.append(None)
+            continue
+        x1, y1, x2, y2 = np.clip(boxes[0] / scale, 0, [w, h, w, h]).astype(int)
+        out.append((x1, y1, x2, y2) if x2 > x1 and y2 > y1 else None)
+    return out
+
+
+def art_cloak_frames(
+    image_b64,
+    intensity=0.01,
+    targeted=False,
+    target_idx=None,
+    tier="standard",
+    change_threshold=FRAME_CHANGE_THRESHOLD,
+):
+    """
+    Generator, one dict per frame: index, duration, keyframe, cloaked_image (base64 PNG).
+    target_idx None means each keyframe uses its own top-1 class.
+    """
+    surrogate = get_surrogate(tier)
+    ref_sig, delta, index = None, None, 0
+
+    for window in _frame_windows(image_b64):
+        flags, ref_sig = _select_keyframes(window, ref_sig, change_threshold)
+        keys = [i for i, is_key in enumerate(flags) if is_key]
+
+        if keys:
+            def loss_fn(out):
+                if target_idx is None:
+                    targets = out.argmax(dim=1).detach()
+                else:
+                    targets = torch.full((len(keys),), target_idx, device=device)
+                return F.cross_entropy(out, targets, reduction="sum")
+
+            buf = torch.stack([pil_to_uint8(window[i][0]) for i in keys])
+            _, grad, _ = input_grad(surrogate, buf, loss_fn)
+            grad_sign = -grad.sign() if targeted else grad.sign()
+            key_deltas = intensity * grad_sign * IMAGENET_STD
+
+        k = 0
+        for (frame, duration), is_key in zip(window, flags):
+            if is_key:
+                delta = key_deltas[k:k + 1]
+                k += 1
+            orig_px = uint8_to_pixels(pil_to_uint8(frame))
+            delta_up = F.interpolate(delta, size=orig_px.shape[-2:], mode="bilinear", align_corners=False)
+            perturbed = torch.clamp(orig_px + delta_up, 0.0, 1.0)
+
+            yield {
+                "index": index,
+                "duration": duration,
+                "keyframe": is_key,
+                "cloaked_image": tensor_to_base64(perturbed),
+            }
+            index += 1
+
+
+def face_cloak_frames(
+    image_b64,
+    intensity=0.01,
+    method="fgsm",
+    target_identity_img=None,
+    change_threshold=FRAME_CHANGE_THRESHOLD,
+):
+    """
+    Generator, one dict per frame: index, duration, keyframe, face_detected,
+    cloaked_image (base64 PNG). Frames without a face pass through unchanged.
+    """
+    target_emb = None
+    if target_identity_img is not None:
+        with torch.no_grad():
+            target_emb = facenet_fused(pil_to_uint8(target_identity_img))
+
+    ref_sig, box, delta, index = None, None, None, 0
+
+    for window in _frame_windows(image_b64):
+        flags, ref_sig = _select_keyframes(window, ref_sig, change_threshold)
+        keys = [i for i, is_key in enumerate(flags) if is_key]
+
+        if keys:
+            key_boxes = detect_faces_batch([window[i][0] for i in keys])
+            crops = [
+                facenet_fused.pixels(pil_to_uint8(window[i][0].crop(b)))
+                for i, b in zip(keys, key_boxes) if b is not None
+            ]
+            if crops:
+                key_deltas, _ = facenet_attack(
+                    torch.cat(crops), intensity=intensity, method=method, target_emb=target_emb
+                )
+
+        k = j = 0
+        for (frame, duration), is_key in zip(window, flags):
+            if is_key:
+                box = key_boxes[k]
+                k += 1
+                delta = None
+                if box is not None:
+                    delta = key_deltas[j:j + 1]
+                    j += 1
+            orig_tensor = uint8_to_pixels(pil_to_uint8(frame))
+            perturbed = orig_tensor if box is None else apply_face_delta(orig_tensor, delta, box)
+
+            yield {
+                "index": index,
+                "duration": duration,
+                "keyframe": is_key,
+                "face_detected": box is not None,
+                "cloaked_image": tensor_to_base64(perturbed),
+            }
+            index += 1
+
+
+def frames_response(records):
+    """
+    Streams frame dicts as NDJSON, followed by a summary line.
+    The admitted cost is released when the stream closes: teardown_request may
+    run before the body starts, which would free it before any frame is cloaked.
+    """
+    cost = g.pop("admitted_cost", None)
+
+    def generate():
+        count = keyframes = 0
+        for record in records:
+            count += 1
+            keyframes += int(record["keyframe"])
+            yield json.dumps(record) + "\n"
+        yield json.dumps({"done": True, "frames": count, "keyframes": keyframes}) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    if cost is not None:
+        response.call_on_close(lambda: admission.release(cost))
+    return response
+
+
 @app.route("/face-cloak", methods=["POST"])
 def cloak_face_api():
     """
     Accepts:
     - multipart file OR image_base64
     - optional target_image OR target_image_base64
+    - optional output: "image" (default) | "delta"
+    - optional frames: "first" (default) | "all" (animated input, NDJSON stream per frame;
+      image output only)
+    - optional identity: true gallery identity for the rank metrics (MIRAGE_GALLERY)
     """
 
     # ---- INPUT IMAGE ----
@@ -494,13 +1542,13 @@ def cloak_face_api():
         if image_file is None:
             return jsonify({"error": "No image provided"}), 400
         # convert multipart → base64
-        orig_img = Image.open(image_file).convert("RGB")
-        image_b64 = pil_to_base64(orig_img)
+        image_b64 = file_to_base64(image_file)
 
     # ---- PARAMETERS ----
     intensity = float(request.form.get("intensity", 0.01))
     method = request.form.get("method", "fgsm").lower()
     targeted = request.form.get("targeted", "false").lower() == "true"
+    output = request.form.get("output", "image").lower()
 
     # ---- TARGET IMAGE (optional) ----
     target_image_b64 = request.form.get("target_image_base64")
@@ -509,8 +1557,32 @@ def cloak_face_api():
         target_file = request.files.get("target_image")
         if target_file is None:
             return jsonify({"error": "Targeted attack requires target_image"}), 400
-        target_img = Image.open(target_file).convert("RGB")
-        target_image_b64 = pil_to_base64(target_img)
+        target_image_b64 = file_to_base64(target_file)
+
+    frames = request.form.get("frames", "first").lower()
+    if frames not in ("first", "all"):
+        return jsonify({"error": "frames must be 'first' or 'all'"}), 400
+    if frames == "all" and output != "image":
+        return jsonify({"error": "frames=all streams cloaked images; output=delta is not supported"}), 400
+
+    # ---- ADMISSION ----
+    rejected = admit_request(
+        image_b64,
+        METHOD_PASSES.get(method, 1.0),
+        frames=frames,
+        intensity=intensity,
+        extra_images=[target_image_b64] if targeted else []
+    )
+    if rejected is not None:
+        return rejected
+
+    if frames == "all":
+        return frames_response(face_cloak_frames(
+            image_b64,
+            intensity=intensity,
+            method=method,
+            target_identity_img=base64_to_pil(target_image_b64) if targeted else None
+        ))
 
     # ---- CALL PURE FUNCTION ----
     cloaked_b64, metrics = face_cloak_from_base64(
@@ -518,16 +1590,79 @@ def cloak_face_api():
         intensity=intensity,
         method=method,
         targeted=targeted,
-        target_image_b64=target_image_b64
+        target_image_b64=target_image_b64,
+        output=output,
+        gallery_identity=request.form.get("identity")
     )
 
     if cloaked_b64 is None:
         return jsonify(metrics), 400
 
-    return jsonify({
-        "cloaked_image": cloaked_b64,
-        "response": metrics
-    }), 200
+    return jsonify(cloak_payload(cloaked_b64, metrics, output)), 200
+
+
+@app.route("/cloak", methods=["POST"])
+def cloak_combined_api():
+    """
+    Art + face protection in one request (see combined_cloak_from_base64).
+    Accepts:
+    - multipart image (or file) OR image_base64
+    - optional intensity, mode, target_class, tier (art) and method, identity (face)
+    - optional budget: shared L-inf bound for the combined delta, in [0, MAX_INTENSITY]
+      (default intensity)
+    """
+
+    # ---- INPUT IMAGE ----
+    image_b64 = request.form.get("image_base64")
+
+    if image_b64 is None:
+        image_file = request.files.get("image") or request.files.get("file")
+        if image_file is None:
+            return jsonify({"error": "No image provided"}), 400
+        image_b64 = file_to_base64(image_file)
+
+    # ---- PARAMETERS ----
+    try:
+        intensity = float(request.form.get("intensity", 0.01))
+    except ValueError:
+        return jsonify({"error": "intensity must be a number"}), 400
+    budget = request.form.get("budget")
+    if budget is not None:
+        try:
+            budget = float(budget)
+        except ValueError:
+            return jsonify({"error": "budget must be a number"}), 400
+        if not 0.0 <= budget <= MAX_INTENSITY:
+            return jsonify({"error": f"budget must be in [0, {MAX_INTENSITY}]"}), 400
+    mode = request.form.get("mode", "untargeted").lower()
+    if mode not in ("untargeted", "targeted"):
+        return jsonify({"error": "mode must be 'untargeted' or 'targeted'"}), 400
+    tier = request.form.get("tier", "standard").lower()
+    if tier not in SURROGATE_TIERS:
+        return jsonify({"error": f"Invalid tier, expected one of {list(SURROGATE_TIERS)}"}), 400
+    method = request.form.get("method", "fgsm").lower()
+
+    # ---- ADMISSION ----
+    passes = TIER_PASSES.get(tier, 1.0) + METHOD_PASSES.get(method, 1.0)
+    rejected = admit_request(image_b64, passes, intensity=intensity)
+    if rejected is not None:
+        return rejected
+
+    cloaked_b64, response = combined_cloak_from_base64(
+        image_b64=image_b64,
+        intensity=intensity,
+        mode=mode,
+        target_class_name=request.form.get("target_class", None),
+        tier=tier,
+        method=method,
+        budget=budget,
+        gallery_identity=request.form.get("identity")
+    )
+
+    if cloaked_b64 is None:
+        return jsonify(response), 400
+
+    return jsonify(cloak_payload(cloaked_b64, response)), 200
 
 
 # @app.route("/face-cloak", methods=["POST"])
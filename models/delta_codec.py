@@ -0,0 +1,130 @@
+"""
+Compact delta-only cloak output ("mirage-delta-v1").
+
+Instead of the full re-encoded image the server can return just the
+perturbation: a small int8-quantized delta patch, the box it covers in the
+original image and the per-channel scale. The client upsamples the patch
+(bilinear) to the box size, adds it to its own copy of the image and clamps.
+
+Layout (little-endian):
+    magic      4s   b"MDLT"
+    version    u8   1
+    flags      u8   bit 0: payload is zlib-compressed
+    image_w    u32  original image size the delta was computed for
+    image_h    u32
+    box        4xu32  x1, y1, x2, y2 (pixel coords, x2/y2 exclusive)
+    patch_w    u16  size of the stored delta patch
+    patch_h    u16
+    scale      3xf32  per-channel dequantization scale (pixel units in [0,1])
+    payload    int8 [3, patch_h, patch_w], C order
+
+Only numpy and Pillow are needed, so this file doubles as the reference
+applier for clients.
+"""
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+DELTA_FORMAT = "mirage-delta-v1"
+
+_MAGIC = b"MDLT"
+_VERSION = 1
+_FLAG_ZLIB = 1
+_HEADER = struct.Struct("<4sBBII4IHH3f")
+
+
+def encode_delta(delta, image_size, box=None, compress=True):
+    """
+    - delta: float array [3,h,w] (or [1,3,h,w]) of pixel-space offsets
+    - image_size: (width, height) of the image the delta applies to
+    - box: (x1, y1, x2, y2) region the delta covers, defaults to the whole image
+    Returns bytes
+    """
+    delta = np.asarray(delta, dtype=np.float32).reshape(-1, *np.shape(delta)[-2:])
+    if delta.shape[0] != 3:
+        raise ValueError("delta must have 3 channels")
+    image_w, image_h = image_size
+    if box is None:
+        box = (0, 0, image_w, image_h)
+
+    peak = np.abs(delta).reshape(3, -1).max(axis=1)
+    scale = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+    q = np.clip(np.rint(delta / scale[:, None, None]), -127, 127).astype(np.int8)
+
+    payload = q.tobytes()
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 6)
+        flags |= _FLAG_ZLIB
+
+    header = _HEADER.pack(
+        _MAGIC, _VERSION, flags, image_w, image_h, *map(int, box),
+        q.shape[2], q.shape[1], *scale.tolist()
+    )
+    return header + payload
+
+
+def decode_delta(blob):
+    """
+    Returns (delta, image_size, box)
+    - delta: float32 array [3,patch_h,patch_w]
+    """
+    fields = _HEADER.unpack_from(blob)
+    magic, version, flags = fields[:3]
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a mirage-delta-v1 blob")
+    image_w, image_h = fields[3:5]
+    box = fields[5:9]
+    patch_w, patch_h = fields[9:11]
+    scale = np.array(fields[11:14], dtype=np.float32)
+
+    payload = blob[_HEADER.size:]
+    if flags & _FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    q = np.frombuffer(payload, dtype=np.int8).reshape(3, patch_h, patch_w)
+    delta = q.astype(np.float32) * scale[:, None, None]
+    return delta, (image_w, image_h), box
+
+
+def apply_delta(img, blob):
+    """
+    Reference applier.
+    - img: PIL image, the same picture that was uploaded
+    - blob: bytes from encode_delta
+    Returns the cloaked PIL RGB image
+    """
+    delta, image_size, box = decode_delta(blob)
+    img = img.convert("RGB")
+    if img.size != tuple(image_size):
+        raise ValueError(f"Delta was computed for a {image_size} image, got {img.size}")
+
+    x1, y1, x2, y2 = box
+    box_w, box_h = x2 - x1, y2 - y1
+    delta_big = np.stack([
+        np.asarray(Image.fromarray(channel).resize((box_w, box_h), Image.BILINEAR))
+        for channel in delta
+    ], axis=-1)
+
+    px = np.asarray(img, dtype=np.float32) / 255.0
+    px[y1:y2, x1:x2] = np.clip(px[y1:y2, x1:x2] + delta_big, 0.0, 1.0)
+    return Image.fromarray(np.clip(px * 255.0 + 0.5, 0, 255).astype(np.uint8))
+
+
+if __name__ == "__main__":
+    import argparse
+    import base64
+
+    parser = argparse.ArgumentParser(description="Apply a mirage-delta-v1 cloak to a local image")
+    parser.add_argument("image")
+    parser.add_argument("delta", help="raw delta file, or the base64 'cloaked_delta' string saved to a file")
+    parser.add_argument("output")
+    args = parser.parse_args()
+
+    with open(args.delta, "rb") as f:
+        blob = f.read()
+    if not blob.startswith(_MAGIC):
+        blob = base64.b64decode(blob)
+
+    apply_delta(Image.open(args.image), blob).save(args.output)
@@ -0,0 +1,206 @@
+"""
+Local identity gallery for measuring face-cloak effectiveness.
+
+A gallery directory holds:
+    embeddings.npy   float32 [N, D], L2-normalized FaceNet embeddings, one row per
+                     enrolled image, rows of the same identity stored contiguously
+    labels.json      identity label of every row
+
+embeddings.npy is memory-mapped, and search runs as chunked matrix multiplies
+followed by a per-identity max, so 100k+ identities stay in the millisecond
+range without loading the matrix into RAM.
+
+Run from the repository root (app.py loads its models from there):
+    python models/gallery.py build <faces_dir> <gallery_dir>
+    python models/gallery.py evaluate <gallery_dir> <probe_dir> [--intensity 0.01] [--method fgsm]
+where faces_dir / probe_dir contain one sub-folder of images per identity.
+"""
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+class IdentityGallery:
+    def __init__(self, path, chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        with open(os.path.join(path, "labels.json")) as f:
+            labels = json.load(f)
+        if len(labels) != len(self.embeddings):
+            raise ValueError("labels.json does not match embeddings.npy")
+
+        # contiguous identity segments -> np.maximum.reduceat over row scores
+        starts = [0] + [i for i in range(1, len(labels)) if labels[i] != labels[i - 1]]
+        self.identities = [labels[i] for i in starts]
+        if len(set(self.identities)) != len(self.identities):
+            raise ValueError("Gallery rows must be grouped by identity")
+        self._starts = np.array(starts, dtype=np.int64)
+        self._index = {label: i for i, label in enumerate(self.identities)}
+
+    def __len__(self):
+        return len(self.identities)
+
+    def __contains__(self, identity):
+        return identity in self._index
+
+    def identity_scores(self, queries):
+        """
+        - queries: float array [D] or [Q,D]
+        Returns float32 [Q, num_identities]: best cosine similarity per identity
+        """
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-12)
+
+        scores = np.empty((q.shape[0], self.embeddings.shape[0]), dtype=np.float32)
+        for start in range(0, self.embeddings.shape[0], self.chunk_size):
+            chunk = self.embeddings[start:start + self.chunk_size]
+            scores[:, start:start + len(chunk)] = q @ chunk.T
+        return np.maximum.reduceat(scores, self._starts, axis=1)
+
+    def search(self, queries, k=5):
+        """Top-k identities per query: list (per query) of [(identity, score), ...]."""
+        ident_scores = self.identity_scores(queries)
+        k = min(k, ident_scores.shape[1])
+        results = []
+        for row in ident_scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([(self.identities[i], float(row[i])) for i in top])
+        return results
+
+    def ranks(self, queries, identity=None):
+        """
+        1-based rank of identity for each query (1 = recognized as top match).
+        identity None uses the top match of the first query (e.g. the uncloaked face),
+        whose rank is then 1 by construction rather than measured.
+        Returns (identity, ranks)
+        """
+        ident_scores = self.identity_scores(queries)
+        if identity is None:
+            index = int(ident_scores[0].argmax())
+        else:
+            index = self._index[identity]
+        true_scores = ident_scores[:, index]
+        return self.identities[index], (ident_scores > true_scores[:, None]).sum(axis=1) + 1
+
+
+def iter_identity_images(root):
+    """Yields (identity, image_path) for root/<identity>/<image>, grouped by identity."""
+    for identity in sorted(os.listdir(root)):
+        folder = os.path.join(root, identity)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield identity, os.path.join(folder, name)
+
+
+def build_gallery(faces_dir, out_dir, embed_fn):
+    """
+    - faces_dir: folder with one sub-folder of face images per identity
+    - out_dir: gallery directory to write
+    - embed_fn: image path -> embedding [D] (or None to skip, e.g. no face found)
+    Rows are streamed to disk, so memory stays flat for large galleries.
+    Returns the number of enrolled rows
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    labels, dim = [], None
+
+    with tempfile.TemporaryFile() as raw:
+        for identity, image_path in iter_identity_images(faces_dir):
+            emb = embed_fn(image_path)
+            if emb is None:
+                continue
+            emb = np.asarray(emb, dtype=np.float32).ravel()
+            emb /= np.linalg.norm(emb) + 1e-12
+            dim = emb.shape[0]
+            raw.write(emb.tobytes())
+            labels.append(identity)
+
+        if not labels:
+            raise ValueError(f"No faces enrolled from {faces_dir}")
+
+        raw.seek(0)
+        with open(os.path.join(out_dir, "embeddings.npy"), "wb") as f:
+            np.lib.format.write_array_header_1_0(
+                f, {"descr": "<f4", "fortran_order": False, "shape": (len(labels), dim)}
+            )
+            while True:
+                block = raw.read(1 << 24)
+                if not block:
+                    break
+                f.write(block)
+
+    with open(os.path.join(out_dir, "labels.json"), "w") as f:
+        json.dump(labels, f)
+    return len(labels)
+
+
+def evaluate(probe_dir, intensity=0.01, method="fgsm"):
+    """
+    Cloaks every probe image and reports the true identity's gallery rank before
+    and after. Needs app.gallery to be loaded.
+    """
+    import app
+    from PIL import Image
+
+    rows = []
+    for identity, image_path in iter_identity_images(probe_dir):
+        if identity not in app.gallery:
+            continue
+        img = Image.open(image_path).convert("RGB")
+        _, _, metrics = app.face_delta(img, intensity=intensity, method=method, gallery_identity=identity)
+        if "gallery" in metrics and not metrics["gallery"].get("identity_inferred"):
+            rows.append(metrics["gallery"])
+
+    if not rows:
+        return {"probes": 0}
+
+    before = np.array([r["rank_before"] for r in rows])
+    after = np.array([r["rank_after"] for r in rows])
+    return {
+        "probes": len(rows),
+        "gallery_identities": len(app.gallery),
+        "top1_before": float((before == 1).mean()),
+        "top1_after": float((after == 1).mean()),
+        "top5_before": float((before <= 5).mean()),
+        "top5_after": float((after <= 5).mean()),
+        "median_rank_before": float(np.median(before)),
+        "median_rank_after": float(np.median(after)),
+        "mean_search_ms": float(np.mean([r["search_ms"] for r in rows])),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or evaluate against a face identity gallery")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build_p = sub.add_parser("build")
+    build_p.add_argument("faces_dir")
+    build_p.add_argument("gallery_dir")
+
+    eval_p = sub.add_parser("evaluate")
+    eval_p.add_argument("gallery_dir")
+    eval_p.add_argument("probe_dir")
+    eval_p.add_argument("--intensity", type=float, default=0.01)
+    eval_p.add_argument("--method", default="fgsm")
+
+    args = parser.parse_args()
+
+    import app
+
+    if args.command == "build":
+        start = time.perf_counter()
+        n = build_gallery(args.faces_dir, args.gallery_dir, app.face_embedding_from_path)
+        print(f"Enrolled {n} images in {time.perf_counter() - start:.1f}s -> {args.gallery_dir}")
+    else:
+        app.gallery = IdentityGallery(args.gallery_dir)
+        print(json.dumps(evaluate(args.probe_dir, args.intensity, args.method), indent=2))
@@ -0,0 +1,83 @@
+import pytest
+
+import admission
+from admission import AdmissionController, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", fake)
+    return fake
+
+
+def test_bucket_take_and_refill(clock):
+    bucket = TokenBucket(capacity=10.0, rate=2.0)
+
+    assert bucket.take(6.0) == 0.0
+    assert bucket.level() == pytest.approx(4.0)
+    # short by 2 tokens at 2 tokens/s
+    assert bucket.take(6.0) == pytest.approx(1.0)
+    assert bucket.level() == pytest.approx(4.0)
+
+    clock.now += 1.0
+    assert bucket.take(6.0) == 0.0
+    assert bucket.level() == pytest.approx(0.0)
+
+    # refill is capped at capacity
+    clock.now += 60.0
+    assert bucket.level() == pytest.approx(10.0)
+
+
+def test_admit_and_release(clock):
+    controller = AdmissionController(client_capacity=10.0, global_capacity=100.0, max_inflight=50.0)
+
+    assert controller.admit("a", 4.0) is None
+    assert controller.report()["inflight_cost"] == pytest.approx(4.0)
+    controller.release(4.0)
+    assert controller.report()["inflight_cost"] == pytest.approx(0.0)
+
+
+def test_admit_rejects_inflight_first(clock):
+    controller = AdmissionController(client_capacity=10.0, global_capacity=100.0, max_inflight=8.0)
+
+    assert controller.admit("a", 6.0) is None
+    rejection = controller.admit("b", 6.0)
+    assert rejection.status == 503
+    assert rejection.error == "Server busy"
+    # the in-flight check runs before any bucket is charged
+    assert "b" not in controller._clients
+
+
+def test_admit_rejects_client_budget(clock):
+    controller = AdmissionController(client_capacity=10.0, client_rate=2.0, global_capacity=100.0)
+
+    assert controller.admit("a", 8.0) is None
+    rejection = controller.admit("a", 8.0)
+    assert rejection.status == 429
+    assert rejection.retry_after == pytest.approx(3.0)
+    # other clients keep their own budget
+    assert controller.admit("b", 8.0) is None
+
+
+def test_admit_rejects_global_budget_and_refunds_client(clock):
+    controller = AdmissionController(client_capacity=10.0, global_capacity=12.0, global_rate=1.0)
+
+    assert controller.admit("a", 8.0) is None
+    rejection = controller.admit("b", 8.0)
+    assert rejection.status == 503
+    assert rejection.error == "Server cost budget exhausted"
+    assert rejection.retry_after == pytest.approx(4.0)
+    assert controller._clients["b"].level() == pytest.approx(10.0)
+
+    report = controller.report()
+    assert report["admitted"] == 1
+    assert report["rejected_503"] == 1
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from delta_codec import apply_delta, decode_delta, encode_delta
+
+
+def make_image(w=64, h=48):
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(40, 215, size=(h, w, 3), dtype=np.uint8))
+
+
+def test_round_trip_whole_image():
+    rng = np.random.default_rng(1)
+    delta = rng.uniform(-0.03, 0.03, size=(3, 48, 64)).astype(np.float32)
+
+    blob = encode_delta(delta, (64, 48))
+    decoded, image_size, box = decode_delta(blob)
+
+    assert image_size == (64, 48)
+    assert box == (0, 0, 64, 48)
+    assert decoded.shape == (3, 48, 64)
+    # int8 quantization error is at most half a step per channel
+    step = np.abs(delta).reshape(3, -1).max(axis=1) / 127.0
+    assert np.all(np.abs(decoded - delta) <= step[:, None, None] / 2 + 1e-7)
+
+    img = make_image()
+    cloaked = np.asarray(apply_delta(img, blob), dtype=np.float32) / 255.0
+    expected = np.clip(np.asarray(img, dtype=np.float32) / 255.0 + decoded.transpose(1, 2, 0), 0.0, 1.0)
+    assert np.abs(cloaked - expected).max() <= 1.0 / 255.0 + 1e-6
+
+
+def test_round_trip_box_uncompressed():
+    delta = np.full((1, 3, 8, 10), 0.05, dtype=np.float32)
+    box = (20, 10, 40, 26)
+
+    blob = encode_delta(delta, (64, 48), box=box, compress=False)
+    decoded, image_size, decoded_box = decode_delta(blob)
+
+    assert image_size == (64, 48)
+    assert decoded_box == box
+    assert decoded.shape == (3, 8, 10)
+
+    img = make_image()
+    before = np.asarray(img, dtype=np.int16)
+    after = np.asarray(apply_delta(img, blob), dtype=np.int16)
+    x1, y1, x2, y2 = box
+
+    outside = np.ones(before.shape[:2], dtype=bool)
+    outside[y1:y2, x1:x2] = False
+    assert np.array_equal(after[outside], before[outside])
+    # +0.05 is ~13 levels; source pixels are < 215 so nothing clips
+    assert np.all(np.abs(after[y1:y2, x1:x2] - before[y1:y2, x1:x2] - 13) <= 1)
+
+
+def test_apply_rejects_other_image_size():
+    blob = encode_delta(np.zeros((3, 4, 4), dtype=np.float32), (32, 32))
+    with pytest.raises(ValueError):
+        apply_delta(make_image(), blob)
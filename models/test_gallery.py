@@ -0,0 +1,129 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from gallery import IdentityGallery, build_gallery
+
+
+def write_gallery(path, embeddings, labels):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "embeddings.npy"), np.asarray(embeddings, dtype=np.float32))
+    with open(os.path.join(path, "labels.json"), "w") as f:
+        json.dump(labels, f)
+
+
+def random_gallery(path, counts, dim=16, seed=0):
+    """counts: rows per identity, e.g. {"a": 3, "b": 1}; returns (embeddings, labels)"""
+    rng = np.random.default_rng(seed)
+    labels = [identity for identity, n in counts.items() for _ in range(n)]
+    emb = rng.normal(size=(len(labels), dim)).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    write_gallery(path, emb, labels)
+    return emb, labels
+
+
+def brute_force_scores(emb, labels, queries):
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    identities = list(dict.fromkeys(labels))
+    rows = queries @ emb.T
+    return np.stack([
+        rows[:, [i for i, label in enumerate(labels) if label == identity]].max(axis=1)
+        for identity in identities
+    ], axis=1)
+
+
+def test_build_gallery_writes_loadable_npy(tmp_path):
+    faces = tmp_path / "faces"
+    rng = np.random.default_rng(3)
+    vectors = {}
+    for identity, names in {"alice": ["1.jpg", "2.png"], "bob": ["1.jpg", "skip.jpg"], "carol": ["1.webp"]}.items():
+        (faces / identity).mkdir(parents=True)
+        for name in names:
+            path = faces / identity / name
+            path.write_bytes(b"")
+            vectors[str(path)] = None if name == "skip.jpg" else rng.normal(size=4)
+    (faces / "alice" / "notes.txt").write_text("not an image")
+
+    n = build_gallery(str(faces), str(tmp_path / "gallery"), lambda p: vectors[p])
+
+    assert n == 4
+    emb = np.load(tmp_path / "gallery" / "embeddings.npy")
+    assert emb.dtype == np.float32
+    assert emb.shape == (4, 4)
+    enrolled = [v / np.linalg.norm(v) for v in vectors.values() if v is not None]
+    assert np.allclose(emb, enrolled, atol=1e-6)
+    with open(tmp_path / "gallery" / "labels.json") as f:
+        assert json.load(f) == ["alice", "alice", "bob", "carol"]
+
+    gallery = IdentityGallery(str(tmp_path / "gallery"))
+    assert gallery.identities == ["alice", "bob", "carol"]
+    assert len(gallery) == 3
+    assert "bob" in gallery and "dave" not in gallery
+
+
+def test_build_gallery_without_faces(tmp_path):
+    (tmp_path / "faces" / "alice").mkdir(parents=True)
+    (tmp_path / "faces" / "alice" / "1.jpg").write_bytes(b"")
+    with pytest.raises(ValueError):
+        build_gallery(str(tmp_path / "faces"), str(tmp_path / "gallery"), lambda p: None)
+
+
+@pytest.mark.parametrize("chunk_size", [65536, 3, 1])
+def test_identity_scores_max_per_identity(tmp_path, chunk_size):
+    emb, labels = random_gallery(str(tmp_path), {"a": 3, "b": 1, "c": 4, "d": 2})
+    gallery = IdentityGallery(str(tmp_path), chunk_size=chunk_size)
+    queries = np.random.default_rng(1).normal(size=(5, emb.shape[1])).astype(np.float32)
+
+    scores = gallery.identity_scores(queries)
+
+    assert scores.shape == (5, 4)
+    assert np.allclose(scores, brute_force_scores(emb, labels, queries), atol=1e-5)
+    # a single [D] query is promoted to [1, D]
+    assert np.allclose(gallery.identity_scores(queries[0]), scores[:1], atol=1e-5)
+
+
+def test_search_orders_top_k(tmp_path):
+    emb, labels = random_gallery(str(tmp_path), {"a": 2, "b": 2, "c": 1, "d": 3, "e": 1})
+    gallery = IdentityGallery(str(tmp_path), chunk_size=2)
+    queries = np.random.default_rng(2).normal(size=(3, emb.shape[1])).astype(np.float32)
+    expected = brute_force_scores(emb, labels, queries)
+
+    results = gallery.search(queries, k=3)
+
+    assert len(results) == 3
+    for row, result in zip(expected, results):
+        assert [identity for identity, _ in result] == [gallery.identities[i] for i in np.argsort(-row)[:3]]
+        scores = [score for _, score in result]
+        assert scores == sorted(scores, reverse=True)
+    # k larger than the gallery returns every identity
+    assert len(gallery.search(queries[0], k=50)[0]) == 5
+
+
+def test_ranks(tmp_path):
+    emb, _ = random_gallery(str(tmp_path), {"a": 2, "b": 1, "c": 2})
+    gallery = IdentityGallery(str(tmp_path))
+    # query 0 is a's own row; query 1 is c's row, so "a" drops below "c"
+    queries = np.stack([emb[0], emb[3]])
+
+    identity, ranks = gallery.ranks(queries, "a")
+    assert identity == "a"
+    assert ranks[0] == 1
+    assert ranks[1] > 1
+
+    # no identity: the first query's top match, ranked 1 by construction
+    identity, ranks = gallery.ranks(queries)
+    assert identity == "a"
+    assert ranks[0] == 1
+
+
+def test_rejects_ungrouped_or_mismatched_labels(tmp_path):
+    emb = np.eye(3, dtype=np.float32)
+    write_gallery(str(tmp_path / "ungrouped"), emb, ["a", "b", "a"])
+    with pytest.raises(ValueError):
+        IdentityGallery(str(tmp_path / "ungrouped"))
+
+    write_gallery(str(tmp_path / "mismatched"), emb, ["a", "b"])
+    with pytest.raises(ValueError):
+        IdentityGallery(str(tmp_path / "mismatched"))
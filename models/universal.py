@@ -0,0 +1,188 @@
+"""
+Universal perturbations: one delta per profile (user / style / class).
+
+A profile delta is trained offline over a batch of the owner's images with
+the same surrogate and L-inf budget as fgsm_highres_cloak (epsilon * ImageNet
+std per channel), then served with only resize + add + clamp, no model call.
+
+Profiles are stored as PROFILE_DIR/<name>.pt:
+    {"delta": float16 [3,S,S] pixel-space delta, "epsilon", "tier",
+     "target_class", "targeted", "images", "fooling_rate"}
+
+Train from the repository root (app.py loads its models from there):
+    python models/universal.py <images_dir> <profile> [--epsilon 0.01] [--tier standard]
+        [--epochs 5] [--batch-size 16] [--target-class "tabby, tabby cat" --targeted]
+"""
+import os
+import re
+import threading
+
+import torch
+import torch.nn.functional as F
+
+PROFILE_DIR = os.environ.get("MIRAGE_PROFILE_DIR", os.path.join("models", "profiles"))
+
+_PROFILE_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+_profile_cache = {}
+_profile_lock = threading.Lock()
+
+
+class UniversalPerturbation(torch.nn.Module):
+    """Adds a stored low-res delta to images of any size (bilinear upsample + clamp)."""
+
+    def __init__(self, delta):
+        super().__init__()
+        self.register_buffer("delta", delta.float().reshape(1, *delta.shape[-3:]))
+
+    def forward(self, x):
+        """x: float [B,3,H,W] pixels in [0,1]"""
+        delta = self.delta
+        if tuple(delta.shape[-2:]) != tuple(x.shape[-2:]):
+            delta = F.interpolate(delta, size=x.shape[-2:], mode="bilinear", align_corners=False)
+        return torch.clamp(x + delta, 0.0, 1.0)
+
+
+def train_universal_perturbation(
+    model,
+    images,
+    bound,
+    epochs=5,
+    batch_size=16,
+    step=0.25,
+    target_idx=None,
+    targeted=False,
+):
+    """
+    - model: surrogate taking float [B,3,S,S] pixels in [0,1] (e.g. a FusedPreprocess)
+    - images: float tensor [N,3,S,S] in [0,1] at the surrogate resolution (any device)
+    - bound: per-channel L-inf budget, tensor [1,3,1,1] on the model's device
+    - step: sign-gradient step size as a fraction of bound
+    - target_idx / targeted: same meaning as in fgsm_highres_cloak; target_idx None
+      uses each image's clean top-1 class
+    Returns (delta [1,3,S,S], fooling_rate)
+    """
+    device = bound.device
+    model.eval()
+
+    with torch.no_grad():
+        clean = torch.cat([
+            model(images[i:i + batch_size].to(device)).argmax(dim=1)
+            for i in range(0, len(images), batch_size)
+        ])
+    labels = clean if target_idx is None else torch.full_like(clean, target_idx)
+
+    delta = torch.zeros(1, *images.shape[1:], device=device)
+    for _ in range(epochs):
+        order = torch.randperm(len(images))
+        for i in range(0, len(images), batch_size):
+            idx = order[i:i + batch_size]
+            x = images[idx].to(device)
+            delta.requires_grad_(True)
+            loss = F.cross_entropy(model(torch.clamp(x + delta, 0.0, 1.0)), labels[idx.to(device)])
+            grad = torch.autograd.grad(loss, delta)[0]
+
+            grad_sign = -grad.sign() if targeted else grad.sign()
+            delta = delta.detach() + step * bound * grad_sign
+            delta = torch.max(torch.min(delta, bound), -bound)
+
+    with torch.no_grad():
+        preds = torch.cat([
+            model(torch.clamp(images[i:i + batch_size].to(device) + delta, 0.0, 1.0)).argmax(dim=1)
+            for i in range(0, len(images), batch_size)
+        ])
+    fooled = (preds == labels) if targeted else (preds != labels)
+    return delta.detach(), float(fooled.float().mean())
+
+
+def profile_path(name):
+    if not _PROFILE_NAME.match(name):
+        raise ValueError(f"Invalid profile name: {name}")
+    return os.path.join(PROFILE_DIR, f"{name}.pt")
+
+
+def save_profile(name, delta, **meta):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path(name)
+    # write then rename, so a running server never loads a half-written profile
+    tmp = f"{path}.tmp{os.getpid()}"
+    torch.save({"delta": delta.reshape(delta.shape[-3:]).half().cpu(), **meta}, tmp)
+    os.replace(tmp, path)
+    with _profile_lock:
+        _profile_cache.pop(name, None)
+
+
+def load_profile(name):
+    """
+    Returns the stored profile dict, or None if it does not exist.
+    Cached per file version (mtime, size), so a profile retrained by the CLI
+    while the server runs is picked up on the next request.
+    """
+    path = profile_path(name)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (st.st_mtime_ns, st.st_size)
+
+    with _profile_lock:
+        cached = _profile_cache.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # loaded outside the lock: a first load must not block other profiles
+    profile = torch.load(path, map_location="cpu")
+    with _profile_lock:
+        _profile_cache[name] = (version, profile)
+    return profile
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from PIL import Image
+
+    from gallery import IMAGE_EXTENSIONS
+
+    parser = argparse.ArgumentParser(description="Train a universal perturbation profile")
+    parser.add_argument("images_dir")
+    parser.add_argument("profile")
+    parser.add_argument("--epsilon", type=float, default=0.01)
+    parser.add_argument("--tier", default="standard")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--target-class", default=None)
+    parser.add_argument("--targeted", action="store_true")
+    args = parser.parse_args()
+
+    import app
+
+    surrogate = app.get_surrogate(args.tier)
+    paths = sorted(
+        os.path.join(args.images_dir, name) for name in os.listdir(args.images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    images = torch.cat([
+        surrogate.pixels(app.pil_to_uint8(Image.open(p).convert("RGB"))).cpu() for p in paths
+    ])
+    target_idx = app.idx_to_class.index(args.target_class) if args.target_class else None
+
+    delta, fooling_rate = train_universal_perturbation(
+        surrogate,
+        images,
+        bound=args.epsilon * app.IMAGENET_STD,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
+        target_idx=target_idx,
+        targeted=args.targeted,
+    )
+    save_profile(
+        args.profile,
+        delta,
+        epsilon=args.epsilon,
+        tier=args.tier,
+        target_class=args.target_class,
+        targeted=args.targeted,
+        images=len(paths),
+        fooling_rate=fooling_rate,
+    )
+    print(f"Profile '{args.profile}': {len(paths)} images, fooling rate {fooling_rate:.3f} -> {profile_path(args.profile)}")